@@ -7,28 +7,28 @@
 # A python script that collects the travel duration of a route request from the
 # googlemaps duration API and writes the result in a SQLite database.
 #
-# SQLite table format:
-#+-------------------------------------------+ track_id:    unique integer id of the track
-#|                   route                   | start:       start addres of the route
-#+----------+-------+-------------+----------+ destination: destination address 
-#| track_id | start | destination | duration | duration:    google duration result 
-#+----------+-------+-------------+----------+              (without traffic consideration)
-#|          |       |             |          |
-#+----------+-------+-------------+----------+
-#
-#+---------------------------------------+ track_id: track id from route table
-#|             track_duration            | duration_in_traffic: Google duration result
-#+----------+------+---------------------+                      (considering traffic)
-#| track_id | time | duration_in_traffic | time: timestamp of the request in seconds
-#+----------+------+---------------------+       since since midnight, January 1, 1970 UTC
-#|          |      |                     |
-#+----------+------+---------------------+
-#
+# To keep the cronjob short, the script only appends the result as one JSON line
+# to pending.jsonl next to the script:
+#   {"time": ..., "start": ..., "destination": ..., "duration": ...,
+#    "duration_in_traffic": ...}
+# The pending samples are written to the SQLite database in one transaction by
+# pending2db.py, which runs e.g. once per hour. See init_db.py for the table format.
 #
 # The start and destination of the route are passed as arguments to the script.
 # Use i.e. the home address as start and the work address as destination for the
 # way to work. For the way home reverse the start and destination address.
 #
+# Several routes can be requested by one call with a JSON routes file (--routes),
+# each route with its own hours and weekdays (see load_routes()). The routes
+# scheduled at the time of the call are requested in parallel and all samples
+# are written at once.
+#
+# API requests failing with a transient error (timeout, connection error, server
+# error, rate limit) are retried up to three times. If all of them fail, the
+# sample is still recorded, with NULL as duration_in_traffic, so the gap shows up
+# in the collected data. Permanent errors (i.e. wrong API key or address) are
+# logged and no sample is recorded.
+#
 # The script is intended to be used as a cronjob target on a linux server.
 # I. e. ehe script may  be called every 5 minutes from 5-9am and 14-19pm for a view
 # months. By processing the data collected in the SQLite database the optimum 
@@ -37,18 +37,46 @@
 # Excample crontab entries (crontab -l)
 #   */5 5-9 * * 1-5 python3 /home/holzi/dur2work/dur2work.py "<HOME_ADDRESSS>" "<WORK_ADDRESSS>"
 #   */5 14-19 * * 1-5 python3 /home/holzi/dur2work/dur2work.py "<WORK_ADDRESSS>" "<HOME_ADDRESSS>"
+#   0 * * * * python3 /home/holzi/dur2work/pending2db.py
+#
+# The same with a routes file listing both ways with hours 5-9 and 14-19:
+#   */5 5-9,14-19 * * 1-5 python3 /home/holzi/dur2work/dur2work.py --routes /home/holzi/dur2work/routes.json
+#
+# Alternatively the script can run as a daemon (--daemon), i.e. started by a
+# systemd service. The daemon imports the modules, creates the HTTPS session
+# and opens the database only once and requests the route on the same schedule
+# as the cronjob. The samples are kept in memory and written to the database in
+# one transaction every --flush-interval minutes, when the scheduled hours are
+# over and when the daemon is stopped; pending2db.py is not needed in this case.
+# Same schedule as the first crontab entry above:
+#   python3 dur2work.py --daemon --interval 5 --hours 5-9 --weekdays 1-5 "<HOME_ADDRESSS>" "<WORK_ADDRESSS>"
+# Or both ways in one daemon:
+#   python3 dur2work.py --daemon --weekdays 1-5 --routes routes.json
 #
 #---------------------------------------------------------------------------------
 # Prerequisites
-# - googlemaps python module (pip install googlemaps)
+# - requests python module (pip install requests)
 # - Googlemaps directions API key located in a textfile: api_key.txt in the same
 #   folder as the script
+# - Database created once with init_db.py
 #---------------------------------------------------------------------------------
-# usage: dur2work.py [-h] start destination
+# usage: dur2work.py [-h] [--routes FILE] [--hours RANGE] [--weekdays RANGE]
+#                    [--daemon] [--interval MINUTES] [--flush-interval MINUTES]
+#                    [start] [destination]
 # Writes resonses from google maps drections API to a SQLite database
 # positional arguments:
-#   start        Start/beginning of the track
-#   destination  Destination/end of the track
+#   start               Start/beginning of the track
+#   destination         Destination/end of the track
+# optional arguments:
+#   --routes FILE       JSON file with the routes to request, instead of start
+#                       and destination
+#   --hours RANGE       Hours of the day to request the routes, i.e. 5-9 (default: 0-23)
+#   --weekdays RANGE    Days of the week to request the routes, 1=monday, i.e. 1-5
+#                       (default: 1-7)
+#   --daemon            Run as daemon and request the route on a schedule
+#   --interval MINUTES  Daemon: minutes between two requests (default: 5)
+#   --flush-interval MINUTES
+#                       Daemon: minutes between two database writes (default: 60)
 #---------------------------------------------------------------------------------
 #
 # Created By  : Tobias Ammann
@@ -58,156 +86,378 @@
 
 import os                                 # Get the path of the script
 import sys                                # Get path of the script
+import time                               # Daemon schedule
+import signal                             # Daemon termination
 
 from datetime import timezone, datetime   # Working with time objects
-import sqlite3                            # SQLite database
+from concurrent.futures import ThreadPoolExecutor   # Parallel route requests
+import json                               # Pending samples file
 import argparse                           # Command line arguments
 import logging                            # Logging
 
-import googlemaps                         # Google maps API
-
-# Logfile: Write to console and logfile
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(os.path.join(sys.path[0], "dur2work.log")),
-        logging.StreamHandler()
-    ]
-)
-
-# Argparse
-parser = argparse.ArgumentParser(description='Writes resonses from google maps drections API ' \
-                                             'to a SQLite database')
-# Required arguments
-parser.add_argument('start',   help = 'Start/beginning of the track')
-parser.add_argument('destination', help = 'Destination/end of the track') 
-
-# Parse
-args = parser.parse_args()
-start = args.start
-destination = args.destination
-
-# Read the API key for the googlemaps API from the keyfile
-try:
-    api_key_file = open(os.path.join(sys.path[0], "api_key.txt"), "r")
-    API_KEY = api_key_file.read()
-    api_key_file.close()
-except Exception as e:
-    logging.error('Error reading API key from "api_key.txt"')
-    logging.error(e)
-    exit()
-
-# Create a googemaps client object
-gmaps = googlemaps.Client(key=API_KEY)
-
-# Get the current time in seconds since POSIX, independent of the system epoch
-epoch = datetime(1970, 1, 1, 0, 0, tzinfo=timezone.utc)     #POSIX epoch                              
-curr_time = datetime.now(timezone.utc)                      #Current UTC time 
-curr_time = curr_time - epoch                               #calculate the time difference to a user defined epoch
-curr_time = curr_time.total_seconds()                       #get number of seconds since epoch
-#print(curr_time - datetime.now(timezone.utc).timestamp() )
-
-# Request directions via public transit at current departure time
-try:
-    res = gmaps.directions( start,
-                            destination,
-                            mode='driving',
-                            units='metric',
-                            traffic_model='best_guess',
-                            departure_time=int(curr_time))       # Directions API Definition: Integer in seconds 
-                                                            # since midnight, January 1, 1970 UTC
-except Exception as e:
-    logging.error(e)
-    exit()
-
-if len(res) <= 0:
-    # Googlemaps API route was found for the requested start/end adrees -> end programm
-    logging.error('Google maps API did not return a route for the requested ' \
-                    'start-/end-address.')
-    exit()
-
-# The result is a list containing a dict -> extract legs
-legs = res[0]['legs'][0]
-duration_in_traffic = legs['duration_in_traffic']['value']
-duration            = legs['duration']['value']
-
-# Database handling
-try:
-    db_con = sqlite3.Connection(os.path.join(sys.path[0], "dur.db"))
-    db_cur = db_con.cursor()
-
-except Exception as e:
-    logging.error(e)
-    exit()
-    
-# Create route database
-db_cur.execute('''CREATE TABLE IF NOT EXISTS route
-                     (track_id INTEGER PRIMARY KEY,
-                     start TEXT , 
-                     destination TEXT ,
-                     duration REAL)''')
-
-# Create track_duration database
-db_cur.execute('''CREATE TABLE IF NOT EXISTS track_duration
-                     (track_id INTEGER,
-                     time REAL , 
-                     duration_in_traffic REAL)''')
-
-# Query start and destination
-db_cur.execute('''SELECT track_id FROM route WHERE
-                            start = "{}"  COLLATE NOCASE AND
-                            destination = "{}"
-                            COLLATE NOCASE'''.format(start, destination))
-ids_known_tracks = db_cur.fetchall() 
-
-# Check if the start and end destination are already known (with an assigned track id)
-# Otherwise create a new id 
-if len(ids_known_tracks) == 0:
-
-    # Start and end address unkown, add a new database table
-    logging.info('Unkown route, adding new entry in "route" database')
-
-    # Fetch current maximum id
-    db_cur.execute('''SELECT MAX(track_id) from route''')
-    max_id = db_cur.fetchall() 
-
-    # Initialize max_id if the database was empty
-    if max_id[0][0] is None:
-        max_id[0] = (-1,)
-
-    # Increment the id
-    track_id = max_id[0][0] + 1 
-
-    # Insert new data into the route table
-    db_cur.execute('''INSERT INTO route 
-                        VALUES ({}, '{}', '{}', {})'''.format(track_id, start, destination, duration))
-    db_con.commit()
-
-elif len(ids_known_tracks) == 1:
-
-    # Start and end address known, get track id
-    track_id = ids_known_tracks[0][0]
-else:
-    logging.error("Database error: A SELECT MAX query returned more than one result")
-    exit()
-
-# Insert new data into the track_duration table
-db_cur.execute('''INSERT INTO track_duration 
-                    VALUES ({}, '{}', {})'''.format(track_id, 
-                                                    curr_time,
-                                                    duration_in_traffic))
-db_con.commit()
-
-#Log result
-logging.info('start = ({}) - destination = ({}) - duration_in_traffic = {:.2f}min'.format(start, destination, duration_in_traffic/60))
-
-# # Print entire database
-# print("Database: route")
-# for row in db_cur.execute('''SELECT * FROM route'''):
-#    print(row)
-
-# # Print entire database
-# print("\nDatabase: track_duration")
-# for row in db_cur.execute('''SELECT * FROM track_duration'''):
-#    print(row)
\ No newline at end of file
+import requests                           # Google maps directions API (HTTPS)
+
+import pending2db                         # Database handling
+
+PENDING_FILE = os.path.join(sys.path[0], "pending.jsonl")
+
+# Google maps directions API endpoint, see
+# https://developers.google.com/maps/documentation/directions/get-directions
+DIRECTIONS_URL = "https://maps.googleapis.com/maps/api/directions/json"
+
+# Timeout in seconds for a directions request
+API_TIMEOUT = 10
+
+# Number of attempts for a directions request, waiting 1s, 2s, ... in between
+API_RETRIES = 3
+
+# Directions API status values of errors that may go away on the next attempt
+TRANSIENT_STATUS = ('UNKNOWN_ERROR', 'OVER_QUERY_LIMIT')
+
+
+class ApiError(Exception):
+    """Directions API returned an error status"""
+
+    def __init__(self, status, message=''):
+        super().__init__('{}: {}'.format(status, message))
+        self.status = status
+
+
+def directions(session, start, destination, departure_time):
+    """Request the driving directions between start and destination, returns the
+    list of routes (empty if no route was found)"""
+
+    response = session.get(DIRECTIONS_URL,
+                           params={'origin': start,
+                                   'destination': destination,
+                                   'mode': 'driving',
+                                   'units': 'metric',
+                                   'traffic_model': 'best_guess',
+                                   'departure_time': departure_time},
+                           timeout=API_TIMEOUT)
+    response.raise_for_status()
+    res = response.json()
+
+    if res['status'] == 'ZERO_RESULTS':
+        return []
+    if res['status'] != 'OK':
+        raise ApiError(res['status'], res.get('error_message', ''))
+    return res['routes']
+
+
+def describe_error(e):
+    """Describe an error of a directions request for the log. The message of a
+    requests exception contains the request URL and with it the API key, so
+    only its type (and the HTTP status) is used."""
+
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return '{} (HTTP {})'.format(type(e).__name__, e.response.status_code)
+    if isinstance(e, requests.RequestException):
+        return type(e).__name__
+    return '{}: {}'.format(type(e).__name__, e)
+
+
+def is_transient(e):
+    """True for errors of a directions request that may go away on the next
+    attempt: timeouts, connection errors, HTTP 5xx/429 and the API status
+    values in TRANSIENT_STATUS. Errors like a wrong API key or an unknown
+    address are permanent."""
+
+    if isinstance(e, ApiError):
+        return e.status in TRANSIENT_STATUS
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (e.response.status_code >= 500 or
+                                           e.response.status_code == 429)
+    return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+
+def request_sample(session, start, destination):
+    """Request the route from the googlemaps directions API, returns the sample
+    dict or None if no route was found or the request failed permanently. If a
+    transient error persists for API_RETRIES attempts, the durations of the
+    sample are None."""
+
+    # Time of the sample in seconds since midnight, January 1, 1970 UTC
+    curr_time = int(datetime.now(timezone.utc).timestamp())
+
+    # Request directions via public transit at current departure time. Transient
+    # API errors are retried with an exponential backoff, on permanent errors
+    # the sample is skipped.
+    for attempt in range(API_RETRIES):
+        # The departure time is taken per attempt, after a timeout and the backoff
+        # the first one is in the past and the API rejects it (INVALID_REQUEST)
+        departure_time = int(datetime.now(timezone.utc).timestamp())
+        try:
+            res = directions(session,
+                             start,
+                             destination,
+                             departure_time=departure_time)     # Directions API Definition: Integer in seconds 
+                                                                # since midnight, January 1, 1970 UTC
+            break
+        except (ApiError, requests.RequestException) as e:
+            if not is_transient(e):
+                logging.error('start = ({}) - destination = ({}) - request failed: {}'.format(
+                              start, destination, describe_error(e)))
+                return None
+            logging.warning('Request failed (attempt {}/{}): {}'.format(attempt + 1, API_RETRIES,
+                                                                        describe_error(e)))
+            if attempt < API_RETRIES - 1:
+                time.sleep(2 ** attempt)
+        except Exception as e:
+            logging.error(describe_error(e))
+            return None
+    else:
+        # Record the failed request with NULL durations, so the gap is visible
+        # in the database instead of silently missing
+        logging.error('start = ({}) - destination = ({}) - request failed, recording ' \
+                      'a sample without duration'.format(start, destination))
+        return {'time': curr_time,
+                'start': start,
+                'destination': destination,
+                'duration': None,
+                'duration_in_traffic': None}
+
+    if len(res) <= 0:
+        # Googlemaps API route was found for the requested start/end adrees
+        logging.error('Google maps API did not return a route for the requested ' \
+                        'start-/end-address.')
+        return None
+
+    # The result is a list containing a dict -> extract legs
+    legs = res[0]['legs'][0]
+    duration_in_traffic = legs['duration_in_traffic']['value']
+    duration            = legs['duration']['value']
+
+    #Log result
+    logging.info('start = ({}) - destination = ({}) - duration_in_traffic = {:.2f}min'.format(start, destination, duration_in_traffic/60))
+
+    return {'time': curr_time,
+            'start': start,
+            'destination': destination,
+            'duration': duration,
+            'duration_in_traffic': duration_in_traffic}
+
+
+def append_pending(samples):
+    """Append the samples to the pending file, they are written to the database by pending2db.py"""
+
+    with open(PENDING_FILE, "a") as pending_file:
+        pending_file.write(''.join(json.dumps(sample) + '\n' for sample in samples))
+
+
+def parse_range(text):
+    """Argparse type for cron like ranges, i.e. "5-9" or "7" """
+
+    try:
+        first, _, last = text.partition('-')
+        return range(int(first), int(last or first) + 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid range: "{}"'.format(text))
+
+
+def load_routes(file_name, hours, weekdays):
+    """Read the routes from a JSON file. The file contains a list of routes, each
+    with start, destination and optionally its own hours and weekdays ranges:
+      [{"start": "<HOME_ADDRESSS>", "destination": "<WORK_ADDRESSS>", "hours": "5-9"},
+       {"start": "<WORK_ADDRESSS>", "destination": "<HOME_ADDRESSS>", "hours": "14-19"}]
+    Routes without hours or weekdays use the given defaults."""
+
+    with open(file_name, "r") as routes_file:
+        entries = json.load(routes_file)
+
+    routes = []
+    for entry in entries:
+        routes.append({'start': entry['start'],
+                       'destination': entry['destination'],
+                       'hours': parse_range(entry['hours']) if 'hours' in entry else hours,
+                       'weekdays': parse_range(entry['weekdays']) if 'weekdays' in entry else weekdays})
+    return routes
+
+
+def due_routes(routes, now):
+    """Return the routes that are scheduled at the given local time"""
+
+    return [route for route in routes
+            if now.hour in route['hours'] and now.isoweekday() in route['weekdays']]
+
+
+def request_samples(session, routes):
+    """Request all routes in parallel, returns the list of samples. A route that
+    fails with an unexpected error (i.e. a response without the expected fields)
+    is logged and skipped, it doesn't affect the other routes."""
+
+    if not routes:
+        return []
+
+    with ThreadPoolExecutor(max_workers=len(routes)) as executor:
+        futures = [executor.submit(request_sample, session, route['start'], route['destination'])
+                   for route in routes]
+
+    samples = []
+    for route, future in zip(routes, futures):
+        try:
+            sample = future.result()
+        except Exception as e:
+            logging.error('start = ({}) - destination = ({}) - {}'.format(route['start'],
+                                                                         route['destination'],
+                                                                         describe_error(e)))
+            continue
+        if sample is not None:
+            samples.append(sample)
+    return samples
+
+
+def flush_samples(db_con, samples):
+    """Write the buffered samples to the database, the buffer is cleared on success"""
+
+    if not samples:
+        return
+
+    try:
+        pending2db.write_samples(db_con, samples)
+        samples.clear()
+    except Exception as e:
+        logging.error(e)
+
+
+def run_daemon(session, routes, interval, flush_interval):
+    """Request the routes every interval minutes within their hours and weekdays.
+    The samples are buffered and written to the database every flush_interval
+    minutes, when no route is scheduled and when the daemon is stopped. Runs
+    until it is terminated."""
+
+    # Stop cleanly when terminated, i.e. by systemd
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+
+    db_con = pending2db.open_db()
+    logging.info('Daemon started')
+    for route in routes:
+        logging.info('Route: start = ({}) - destination = ({})'.format(route['start'],
+                                                                      route['destination']))
+
+    samples = []
+    last_flush = time.time()
+    interval_s = interval * 60
+    last_slot = int(time.time() // interval_s)
+    try:
+        while True:
+            # Wait for the next multiple of the interval, like cron does
+            time.sleep(interval_s - time.time() % interval_s)
+
+            # Each interval slot is handled once. If the wall clock was set back
+            # during the sleep, the loop wakes up in a slot that was already
+            # handled and only waits for the next one.
+            slot = int(time.time() // interval_s)
+            if slot <= last_slot:
+                continue
+            last_slot = slot
+
+            routes_now = due_routes(routes, datetime.now())
+            if not routes_now:
+                # Outside of the schedule: write what was collected so far
+                flush_samples(db_con, samples)
+                continue
+
+            # A failing tick must not stop the daemon, the next tick tries again
+            try:
+                samples.extend(request_samples(session, routes_now))
+            except Exception as e:
+                logging.error(describe_error(e))
+
+            if time.time() - last_flush >= flush_interval * 60:
+                flush_samples(db_con, samples)
+                last_flush = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        flush_samples(db_con, samples)
+        db_con.close()
+        logging.info('Daemon stopped')
+
+
+if __name__ == '__main__':
+
+    # Logfile: Write to console and logfile
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[
+            logging.FileHandler(os.path.join(sys.path[0], "dur2work.log")),
+            logging.StreamHandler()
+        ]
+    )
+
+    # Argparse
+    parser = argparse.ArgumentParser(description='Writes resonses from google maps drections API ' \
+                                                 'to a SQLite database')
+    # Route: either start and destination or a routes file
+    parser.add_argument('start', nargs = '?', help = 'Start/beginning of the track')
+    parser.add_argument('destination', nargs = '?', help = 'Destination/end of the track') 
+    parser.add_argument('--routes', metavar = 'FILE',
+                        help = 'JSON file with the routes to request, instead of start and destination')
+
+    # Schedule arguments
+    parser.add_argument('--hours', type = parse_range, default = range(0, 24), metavar = 'RANGE',
+                        help = 'Hours of the day to request the routes, i.e. 5-9 (default: 0-23)')
+    parser.add_argument('--weekdays', type = parse_range, default = range(1, 8), metavar = 'RANGE',
+                        help = 'Days of the week to request the routes, 1=monday, i.e. 1-5 (default: 1-7)')
+
+    # Daemon arguments
+    parser.add_argument('--daemon', action = 'store_true',
+                        help = 'Run as daemon and request the route on a schedule')
+    parser.add_argument('--interval', type = int, default = 5, metavar = 'MINUTES',
+                        help = 'Daemon: minutes between two requests (default: 5)')
+    parser.add_argument('--flush-interval', type = int, default = 60, metavar = 'MINUTES',
+                        help = 'Daemon: minutes between two database writes (default: 60)')
+
+    # Parse
+    args = parser.parse_args()
+    if (args.routes is None and args.destination is None) or \
+       (args.routes is not None and args.start is not None):
+        parser.error('either start and destination or --routes is required')
+    if args.interval < 1:
+        parser.error('argument --interval: must be at least 1 minute')
+    if args.flush_interval < 0:
+        parser.error('argument --flush-interval: must not be negative')
+
+    if args.routes is None:
+        routes = [{'start': args.start,
+                   'destination': args.destination,
+                   'hours': args.hours,
+                   'weekdays': args.weekdays}]
+    else:
+        try:
+            routes = load_routes(args.routes, args.hours, args.weekdays)
+        except Exception as e:
+            logging.error('Error reading routes from "{}"'.format(args.routes))
+            logging.error(e)
+            exit()
+
+    # Read the API key for the googlemaps API from the keyfile, only once per
+    # process. Strip the trailing newline, it would end up in every request.
+    try:
+        with open(os.path.join(sys.path[0], "api_key.txt"), "r") as api_key_file:
+            API_KEY = api_key_file.read().strip()
+    except Exception as e:
+        logging.error('Error reading API key from "api_key.txt"')
+        logging.error(e)
+        exit()
+
+    # Create the HTTPS session for the directions API, the API key is sent with
+    # every request. In daemon mode the connection is reused for all requests.
+    session = requests.Session()
+    session.params = {'key': API_KEY}
+
+    if args.daemon:
+        run_daemon(session, routes, args.interval, args.flush_interval)
+        sys.exit()
+
+    samples = request_samples(session, due_routes(routes, datetime.now()))
+    if not samples:
+        exit()
+
+    try:
+        append_pending(samples)
+    except Exception as e:
+        logging.error(e)
+        exit()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+
+#---------------------------------------------------------------------------------
+# Database setup (init_db.py)
+#
+# Creates the tables of the SQLite database dur.db next to the script. Run it
+# once on install, before the first samples are written:
+#   python3 /home/holzi/dur2work/init_db.py
+#
+# The schema version is stored in the user_version of the database. The
+# database is opened by pending2db.open_db(), which skips all schema statements
+# if the database is already initialized and runs init_db() otherwise. init_db()
+# also migrates the tables of databases created by the first version of
+# dur2work.py (REAL time, case-insensitive duplicate routes). A new
+# database starts with user_version 0, so init_db() always runs for it and
+# removes the track id cache of a previous database.
+#
+# SQLite table format:
+#+-------------------------------------------+ track_id:    unique integer id of the track
+#|                   route                   | start:       start addres of the route
+#+----------+-------+-------------+----------+ destination: destination address
+#| track_id | start | destination | duration | duration:    google duration result
+#+----------+-------+-------------+----------+              (without traffic consideration)
+#|          |       |             |          |
+#+----------+-------+-------------+----------+
+#
+#+---------------------------------------+ track_id: track id from route table
+#|             track_duration            | duration_in_traffic: Google duration result
+#+----------+------+---------------------+                      (considering traffic)
+#| track_id | time | duration_in_traffic | time: timestamp of the request in seconds
+#+----------+------+---------------------+       since since midnight, January 1, 1970 UTC
+#|          |      |                     |
+#+----------+------+---------------------+
+#
+#---------------------------------------------------------------------------------
+# usage: init_db.py [-h]
+#---------------------------------------------------------------------------------
+
+import os                                 # Get the path of the script
+import sys                                # Get path of the script
+
+import sqlite3                            # SQLite database
+import argparse                           # Command line arguments
+import logging                            # Logging
+
+# Track id cache of pending2db.py. The cached ids belong to one database, so the
+# cache is removed whenever the tables are created or migrated.
+CACHE_FILE = os.path.join(sys.path[0], "track_id_cache.json")
+
+# Version of the schema created by init_db(), stored as user_version. Databases
+# of the first version of dur2work.py have user_version 0.
+SCHEMA_VERSION = 1
+
+
+def create_tables(db_cur):
+    """Create the route and track_duration tables if they don't exist"""
+
+    # Create route database
+    db_cur.execute('''CREATE TABLE IF NOT EXISTS route
+                         (track_id INTEGER PRIMARY KEY,
+                         start TEXT ,
+                         destination TEXT ,
+                         duration REAL)''')
+
+    # Create track_duration database
+    db_cur.execute('''CREATE TABLE IF NOT EXISTS track_duration
+                         (track_id INTEGER,
+                         time INTEGER ,
+                         duration_in_traffic REAL)''')
+
+    # Index for analysis queries joining track_duration with route
+    db_cur.execute('''CREATE INDEX IF NOT EXISTS idx_track_duration_tid
+                         ON track_duration(track_id)''')
+
+
+def migrate_time_to_integer(db_cur):
+    """Rebuild track_duration with the time as INTEGER instead of REAL. An
+    integer timestamp needs 5 bytes per row on disk, a REAL always 8 bytes.
+    Follows the table rebuild order of the SQLite documentation, so views of
+    the user on track_duration keep working; triggers are recreated."""
+
+    triggers = [row[0] for row in db_cur.execute('''SELECT sql FROM sqlite_master
+                                                    WHERE type = 'trigger' AND
+                                                          tbl_name = ?''', ('track_duration',))]
+
+    db_cur.execute('''CREATE TABLE track_duration_new
+                         (track_id INTEGER,
+                         time INTEGER ,
+                         duration_in_traffic REAL)''')
+    db_cur.execute('''INSERT INTO track_duration_new
+                        SELECT track_id, CAST(time AS INTEGER), duration_in_traffic
+                        FROM track_duration''')
+    db_cur.execute('DROP TABLE track_duration')
+
+    # Without legacy_alter_table the rename checks the views, which refer to the
+    # dropped table until the rename is done
+    db_cur.execute('PRAGMA legacy_alter_table=ON')
+    try:
+        db_cur.execute('ALTER TABLE track_duration_new RENAME TO track_duration')
+    finally:
+        db_cur.execute('PRAGMA legacy_alter_table=OFF')
+
+    # Recreate the index and triggers dropped with the old table
+    create_tables(db_cur)
+    for trigger in triggers:
+        db_cur.execute(trigger)
+
+
+def create_route_index(db_cur):
+    """Create the unique start/destination index of the route table. Routes
+    stored more than once by the first version of dur2work.py are merged into
+    the one with the lowest track id first, otherwise the index can't be created."""
+
+    # Samples of duplicate routes are moved to the lowest track id of the route
+    db_cur.execute('''UPDATE track_duration SET track_id =
+                        (SELECT MIN(other.track_id) FROM route AS dup, route AS other
+                         WHERE dup.track_id = track_duration.track_id AND
+                               other.start = dup.start COLLATE NOCASE AND
+                               other.destination = dup.destination COLLATE NOCASE)
+                        WHERE track_id IN
+                        (SELECT dup.track_id FROM route AS dup, route AS other
+                         WHERE other.start = dup.start COLLATE NOCASE AND
+                               other.destination = dup.destination COLLATE NOCASE AND
+                               other.track_id < dup.track_id)''')
+
+    # Remove the duplicate routes
+    db_cur.execute('''DELETE FROM route WHERE EXISTS
+                        (SELECT 1 FROM route AS other
+                         WHERE other.start = route.start COLLATE NOCASE AND
+                               other.destination = route.destination COLLATE NOCASE AND
+                               other.track_id < route.track_id)''')
+    if db_cur.rowcount > 0:
+        logging.info('Merged {} duplicate routes in "route" table'.format(db_cur.rowcount))
+
+    # Each start/destination pair may only be stored once. Done with a unique
+    # index instead of a table constraint so it also applies to existing databases
+    db_cur.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_route_start_dest
+                         ON route(start COLLATE NOCASE,
+                         destination COLLATE NOCASE)''')
+
+
+def init_db(db_con):
+    """Create the tables, migrate tables of the first dur2work.py version and set the
+    schema version in one transaction. Removes the track id cache."""
+
+    db_cur = db_con.cursor()
+    db_cur.execute('BEGIN IMMEDIATE')
+    try:
+        create_tables(db_cur)
+
+        # Tables of the first version of dur2work.py store the time as REAL
+        time_type = [row[2] for row in db_cur.execute('PRAGMA table_info(track_duration)')
+                     if row[1] == 'time']
+        if time_type != ['INTEGER']:
+            logging.info('Migrating table "track_duration" to INTEGER time')
+            migrate_time_to_integer(db_cur)
+
+        create_route_index(db_cur)
+
+        db_cur.execute('PRAGMA user_version = {:d}'.format(SCHEMA_VERSION))
+        db_con.commit()
+    except BaseException:
+        db_con.rollback()
+        raise
+
+    # A new or migrated database may use other track ids than the cached ones
+    try:
+        os.remove(CACHE_FILE)
+    except FileNotFoundError:
+        pass
+
+
+if __name__ == '__main__':
+
+    # Logfile: Write to console and logfile
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[
+            logging.FileHandler(os.path.join(sys.path[0], "dur2work.log")),
+            logging.StreamHandler()
+        ]
+    )
+
+    # Argparse
+    parser = argparse.ArgumentParser(description='Creates the tables of the SQLite database')
+    args = parser.parse_args()
+
+    try:
+        db_con = sqlite3.Connection(os.path.join(sys.path[0], "dur.db"))
+        init_db(db_con)
+        db_con.close()
+    except Exception as e:
+        logging.error(e)
+        exit()
+
+    logging.info('Database initialized (schema version {})'.format(SCHEMA_VERSION))
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+
+#---------------------------------------------------------------------------------
+# Pending samples to database (pending2db.py)
+#
+# Writes the samples collected by dur2work.py in pending.jsonl to the SQLite
+# database. All samples are inserted in a single transaction, so there is only
+# one commit (fsync) per flush instead of one per sample.
+#
+# The tables are created by init_db.py (see there for the table format), or on
+# the first flush if it was not run.
+#
+# The track id of a known route is cached in track_id_cache.json next to the
+# script, so the route table is only queried for new routes. The cache is removed
+# when a new database is created.
+#
+# Before flushing, pending.jsonl is renamed to pending.jsonl.flushing, so
+# dur2work.py can keep appending new samples in the meantime. If a flush fails
+# the renamed file is kept. The next run flushes it first and then, in the same
+# run, takes over and flushes pending.jsonl.
+#
+# Excample crontab entry (crontab -l), flush once per hour
+#   0 * * * * python3 /home/holzi/dur2work/pending2db.py
+#
+#---------------------------------------------------------------------------------
+# usage: pending2db.py [-h]
+#---------------------------------------------------------------------------------
+
+import os                                 # Get the path of the script
+import sys                                # Get path of the script
+
+import sqlite3                            # SQLite database
+import argparse                           # Command line arguments
+import logging                            # Logging
+import json                               # Pending samples and track id cache
+
+import init_db                            # Database schema
+
+DB_FILE = os.path.join(sys.path[0], "dur.db")
+CACHE_FILE = init_db.CACHE_FILE
+PENDING_FILE = os.path.join(sys.path[0], "pending.jsonl")
+FLUSHING_FILE = PENDING_FILE + ".flushing"
+
+# SQL statements that run for every flush. Always passing the same string lets
+# sqlite3 reuse its prepared statements from the connection's statement cache.
+SQL_INSERT_ROUTE = '''INSERT OR IGNORE INTO route (start, destination, duration)
+                        VALUES (?, ?, ?)'''
+SQL_SELECT_TRACK_ID = '''SELECT track_id FROM route WHERE
+                            start = ?  COLLATE NOCASE AND
+                            destination = ?
+                            COLLATE NOCASE'''
+SQL_INSERT_DUR = '''INSERT INTO track_duration
+                    VALUES (?, ?, ?)'''
+SQL_UPDATE_ROUTE_DURATION = '''UPDATE route SET duration = ?
+                               WHERE track_id = ? AND duration IS NULL'''
+
+
+def open_db(db_file=DB_FILE):
+    """Open the SQLite database and apply the connection settings"""
+
+    db_con = sqlite3.Connection(db_file)
+
+    # WAL journal with synchronous=NORMAL: one sync per checkpoint instead of
+    # per commit and readers don't block the writer. WAL mode is persistent,
+    # the other settings only apply to this connection.
+    db_con.execute('PRAGMA journal_mode=WAL')
+    db_con.execute('PRAGMA synchronous=NORMAL')
+    db_con.execute('PRAGMA temp_store=MEMORY')
+    db_con.execute('PRAGMA cache_size=-2000')
+
+    # Create the tables only if the database was not set up by init_db.py yet,
+    # an initialized database skips the schema statements
+    if db_con.execute('PRAGMA user_version').fetchone()[0] < init_db.SCHEMA_VERSION:
+        init_db.init_db(db_con)
+
+    return db_con
+
+
+def load_track_id_cache():
+    """Load the track id cache. The cache is removed by init_db() whenever the
+    tables are created or migrated, so it always belongs to the open database."""
+
+    try:
+        with open(CACHE_FILE, "r") as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_track_id_cache(track_id_cache):
+    """Atomically rewrite the track id cache file"""
+
+    try:
+        with open(CACHE_FILE + ".tmp", "w") as cache_file:
+            json.dump(track_id_cache, cache_file)
+        os.replace(CACHE_FILE + ".tmp", CACHE_FILE)
+    except OSError as e:
+        logging.warning('Error writing track id cache "track_id_cache.json"')
+        logging.warning(e)
+
+
+def get_track_id(db_cur, start, destination, duration):
+    """Return the track id of a route, add the route if it is unknown"""
+
+    # Add the route if start and destination are unknown. The track_id (INTEGER
+    # PRIMARY KEY) is assigned by SQLite, a known route is ignored by the unique index
+    db_cur.execute(SQL_INSERT_ROUTE, (start, destination, duration))
+    if db_cur.rowcount > 0:
+        logging.info('Unkown route, adding new entry in "route" database')
+
+    # Query the track id of the route, whether freshly inserted or known
+    db_cur.execute(SQL_SELECT_TRACK_ID, (start, destination))
+    track_id = db_cur.fetchone()[0]
+
+    # A route added by a failed request has no duration yet, fill it in
+    if duration is not None:
+        db_cur.execute(SQL_UPDATE_ROUTE_DURATION, (duration, track_id))
+
+    return track_id
+
+
+def write_samples(db_con, samples):
+    """Insert a list of samples (dicts with the keys start, destination, duration,
+    duration_in_traffic and time) into the database in one transaction"""
+
+    track_id_cache = load_track_id_cache()
+    cache_changed = False
+    db_cur = db_con.cursor()
+
+    # Run all statements in a single write transaction. The write lock is taken
+    # up front, so concurrent writers can't interleave.
+    db_cur.execute('BEGIN IMMEDIATE')
+    try:
+        rows = []
+        for sample in samples:
+            start = sample['start']
+            destination = sample['destination']
+            track_id = track_id_cache.get(start.lower(), {}).get(destination.lower())
+
+            # Route lookup is only needed if the track id is not cached
+            if track_id is None:
+                track_id = get_track_id(db_cur, start, destination, sample['duration'])
+
+                # Only cache the route once its duration is known, until then
+                # the route lookup fills in the duration of the next sample
+                if sample['duration'] is not None:
+                    track_id_cache.setdefault(start.lower(), {})[destination.lower()] = track_id
+                    cache_changed = True
+
+            # Whole seconds, the time column is INTEGER
+            rows.append((track_id, int(sample['time']), sample['duration_in_traffic']))
+
+        # Insert new data into the track_duration table
+        db_cur.executemany(SQL_INSERT_DUR, rows)
+
+        # Commit route and track_duration rows together
+        db_con.commit()
+    except BaseException:
+        db_con.rollback()
+        raise
+
+    # Remember new track ids for the next calls (only once they are committed)
+    if cache_changed:
+        save_track_id_cache(track_id_cache)
+
+
+def read_samples(file_name):
+    """Read the samples of a pending file, skipping incomplete lines"""
+
+    samples = []
+    with open(file_name, "r") as pending_file:
+        for line in pending_file:
+            try:
+                samples.append(json.loads(line))
+            except ValueError:
+                logging.warning('Skipping invalid line in "{}": {}'.format(file_name, line.strip()))
+    return samples
+
+
+if __name__ == '__main__':
+
+    # Logfile: Write to console and logfile
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[
+            logging.FileHandler(os.path.join(sys.path[0], "dur2work.log")),
+            logging.StreamHandler()
+        ]
+    )
+
+    # Argparse
+    parser = argparse.ArgumentParser(description='Writes the samples in pending.jsonl ' \
+                                                 'to a SQLite database')
+    args = parser.parse_args()
+
+    try:
+        # Flush the samples left over by a failed previous run first, then take
+        # over and flush the samples collected since
+        flushed = 0
+        db_con = None
+        for take_over in (False, True):
+            if take_over:
+                try:
+                    os.replace(PENDING_FILE, FLUSHING_FILE)
+                except FileNotFoundError:
+                    # Nothing to flush
+                    break
+            elif not os.path.exists(FLUSHING_FILE):
+                continue
+
+            samples = read_samples(FLUSHING_FILE)
+            if samples:
+                if db_con is None:
+                    db_con = open_db()
+                write_samples(db_con, samples)
+
+            # All samples are in the database
+            os.remove(FLUSHING_FILE)
+            flushed += len(samples)
+
+        if db_con is not None:
+            db_con.close()
+    except Exception as e:
+        logging.error(e)
+        exit()
+
+    if flushed:
+        logging.info('Flushed {} samples to the database'.format(flushed))